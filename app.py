@@ -1,135 +1,420 @@
 import argparse
-import logging
+import base64
+import functools
+import hashlib
 import os
-from datetime import datetime
-
-from flask import Flask, jsonify, render_template
-from flask_paginate import Pagination, get_page_args
-
-from models import BoardCard, Game, Hand, Player, PlayerAction, Round, db
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import (
+    Flask,
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    stream_template,
+    url_for,
+)
+from flask_compress import Compress
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import SmallInteger, bindparam, event, func, inspect, select, text
+from sqlalchemy.orm import configure_mappers, selectinload
+
+import counters
+from log_config import get_logger
+from models import Game, Hand, Player, PlayerAction, Round, db
 from parse_files import parse_files
 
-# Create the /logs directory if it doesn't exist
-log_dir = "./logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-# Configure logging to write to a file and to the console
-log_filename = datetime.now().strftime(f"{log_dir}/%d%m%y_%H%M%S.txt")
-file_handler = logging.FileHandler(log_filename)
-file_handler.setLevel(logging.DEBUG)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.ERROR)  # Only print ERROR messages to console
-
-# Create a logging format
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-
-# Add the handlers to the logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger = get_logger(__name__)
 
 # Ensure the instance directory exists
 instance_dir = os.path.abspath("./instance")
-if not os.path.exists(instance_dir):
-    os.makedirs(instance_dir)
+os.makedirs(instance_dir, exist_ok=True)
+
+# Compiled template bytecode survives restarts in this directory
+jinja_cache_dir = os.path.abspath("./.jinja_cache")
+os.makedirs(jinja_cache_dir, exist_ok=True)
 
 app = Flask(__name__)
+app.jinja_options = {
+    **app.jinja_options,
+    "cache_size": -1,  # Never evict compiled templates
+    "bytecode_cache": FileSystemBytecodeCache(jinja_cache_dir),
+}
 db_path = os.path.join(instance_dir, "poker_hands.db")
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    # Room for every worker thread of the threaded server to hold a
+    # connection; pysqlite already disables check_same_thread for file URLs
+    "pool_size": 10,
+    "max_overflow": 20,
+    "query_cache_size": 1200,
+}
 
 db.init_app(app)
+Compress(app)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets page reads proceed while parse_files is writing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+    connection_record.info["synchronous"] = "NORMAL"
+
+
+# Set while parse_files is bulk loading the database
+ingest_in_progress = threading.Event()
+
+
+def set_ingest_synchronous(dbapi_connection, connection_record, connection_proxy):
+    # PRAGMAs stick to pooled connections, so reconcile them on every checkout
+    mode = "OFF" if ingest_in_progress.is_set() else "NORMAL"
+    if connection_record.info.get("synchronous") != mode:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA synchronous={mode}")
+        cursor.close()
+        connection_record.info["synchronous"] = mode
+
+
+with app.app_context():
+    if db.engine.url.database not in (None, "", ":memory:"):
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+        event.listen(db.engine, "checkout", set_ingest_synchronous)
+
+
+@contextmanager
+def bulk_ingest():
+    """Skip fsyncs on connections checked out while the block runs.
+
+    The ingest can always be repeated from the files in ``data``, so losing it
+    to a power cut is acceptable.
+    """
+    ingest_in_progress.set()
+    try:
+        yield
+    finally:
+        ingest_in_progress.clear()
+
+
+def load_hand_histories():
+    counters.bump()
+    with bulk_ingest():
+        games = parse_files("data")
+        # Builds any indexes rebuild_database dropped, in one sorted pass
+        # each, before the player counts below join through them
+        create_missing_indexes()
+        for game in games:
+            game.update_num_players()
+    counters.bump()
+    # Refresh sqlite_stat1 so the planner picks the foreign key indexes
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+
+
+def create_missing_indexes():
+    # create_all skips tables that already exist, along with their indexes
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def rebuild_database(defer_indexes=False):
+    # Dropping the tables in place keeps the engine, its pool and the
+    # database file, so readers are never left on a deleted file
+    with db.engine.begin() as connection:
+        db.metadata.drop_all(connection)
+        db.metadata.create_all(connection)
+        if defer_indexes:
+            # The secondary indexes are left off while the empty tables fill,
+            # so the inserts don't maintain them row by row. Only done when
+            # nothing is reading, as page queries would scan without them
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(connection)
+    logger.debug("Created new database schema.")
+    load_hand_histories()
+    logger.debug("Finished parsing files.")
+
+
+def stores_action_codes():
+    # Databases built before actions became SMALLINT codes hold their text in
+    # a VARCHAR column; SQLite's text affinity keeps that column from holding
+    # codes, so those databases are rebuilt rather than converted
+    if not inspect(db.engine).has_table("player_action"):
+        return False
+    columns = inspect(db.engine).get_columns("player_action")
+    return any(
+        column["name"] == "action" and isinstance(column["type"], SmallInteger)
+        for column in columns
+    )
 
 
 def initialize_db(persist):
     try:
         logger.debug(f"Database path: {db_path}")
 
-        if not persist:
-            if os.path.exists(db_path):
-                os.remove(db_path)
-                logger.debug("Removed existing database file.")
-
-            with app.app_context():
-                db.create_all()
-                logger.debug("Created new database schema.")
-                parse_files("data")
-                logger.debug("Finished parsing files.")
-
-        if persist and not os.path.exists(db_path):
-            with app.app_context():
-                db.create_all()
-                logger.debug("Created new database schema.")
-                parse_files("data")
-                logger.debug("Finished parsing files.")
+        with app.app_context():
+            if persist and os.path.exists(db_path) and not stores_action_codes():
+                logger.info("Persisted database stores action text; rebuilding it")
+                rebuild_database(defer_indexes=True)
+            elif persist and os.path.exists(db_path):
+                # Databases built before an index was added to the models
+                # get it here
+                create_missing_indexes()
+            else:
+                # Runs before the server starts, so no page reads the tables
+                # while their indexes are missing
+                rebuild_database(defer_indexes=True)
     except Exception as e:
         logger.error(f"Error initializing database. Error: {e}")
 
 
+def read_only(view):
+    """Run ``view`` with autoflush off; it only reads from the session."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with db.session.no_autoflush:
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+def encode_cursor(direction, item_id):
+    return base64.urlsafe_b64encode(f"{direction}{item_id}".encode()).decode()
+
+
+# SQLite's INTEGER range; ids outside it can't be bound as parameters
+MAX_CURSOR_ID = 2**63 - 1
+
+
+def decode_cursor(cursor):
+    """Return ``(direction, id)`` for a cursor from ``encode_cursor``.
+
+    Missing or malformed cursors, and ids outside SQLite's integer range,
+    yield ``(None, None)``, i.e. the first page.
+    """
+    if not cursor:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        if raw[:1] not in ("a", "b"):
+            return None, None
+        item_id = int(raw[1:])
+    except (ValueError, UnicodeDecodeError):
+        return None, None
+    if not -MAX_CURSOR_ID - 1 <= item_id <= MAX_CURSOR_ID:
+        return None, None
+    return raw[0], item_id
+
+
+def cursor_paginate(query, id_column, cursor, per_page):
+    """Return one page of ``query`` ordered by ``id_column``, seeking past the
+    id in ``cursor`` instead of using OFFSET.
+
+    Returns ``(items, prev_cursor, next_cursor)`` where the cursors are
+    ``None`` when there is no page in that direction.
+    """
+    direction, cursor_id = decode_cursor(cursor)
+
+    if direction == "b":
+        items = (
+            query.filter(id_column < cursor_id)
+            .order_by(id_column.desc())
+            .limit(per_page + 1)
+            .all()
+        )
+        has_prev = len(items) > per_page
+        items = items[:per_page][::-1]
+        prev_cursor = encode_cursor("b", items[0].id) if has_prev else None
+        next_cursor = encode_cursor("a", items[-1].id) if items else None
+        return items, prev_cursor, next_cursor
+
+    if direction == "a":
+        query = query.filter(id_column > cursor_id)
+    items = query.order_by(id_column).limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    prev_cursor = (
+        encode_cursor("b", items[0].id) if direction == "a" and items else None
+    )
+    next_cursor = encode_cursor("a", items[-1].id) if has_next else None
+    return items, prev_cursor, next_cursor
+
+
+def make_etag(*parts):
+    return hashlib.blake2b(
+        ":".join(str(part) for part in parts).encode(), digest_size=8
+    ).hexdigest()
+
+
+def is_fresh(etag):
+    # Weak comparison: Compress re-encodes the body but not its meaning
+    return request.if_none_match.contains_weak(etag)
+
+
+def with_etag(response, etag):
+    # Weak tags are left alone by Compress, and no-cache makes browsers
+    # revalidate so a reset database is never served from a stale copy
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route("/")
+@read_only
 def index():
     try:
-        page, per_page, offset = get_page_args(
-            page_parameter="page", per_page_parameter="per_page"
+        per_page = max(1, min(request.args.get("per_page", 10, type=int), 100))
+        cursor = request.args.get("cursor")
+        total = counters.game_count(counters.epoch)
+        # Games only change on a reload, which moves the newest id or the count
+        latest_id = db.session.scalar(select(func.max(Game.id)))
+        etag = make_etag(
+            "index", counters.load_token, latest_id, total, cursor, per_page
+        )
+        if is_fresh(etag):
+            return with_etag(app.response_class(status=304), etag)
+        games, prev_cursor, next_cursor = cursor_paginate(
+            Game.query, Game.id, cursor, per_page
         )
-        total = Game.query.count()
-        games = Game.query.offset(offset).limit(per_page).all()
-        pagination = Pagination(
-            page=page, per_page=per_page, total=total, css_framework="bootstrap4"
+        response = make_response(
+            render_template(
+                "index.html",
+                games=games,
+                total=total,
+                per_page=per_page,
+                prev_cursor=prev_cursor,
+                next_cursor=next_cursor,
+            )
         )
-        return render_template("index.html", games=games, pagination=pagination)
+        return with_etag(response, etag)
     except Exception as e:
         logger.error(f"Error fetching games for index page. Error: {e}")
         return "An error occurred."
 
 
 @app.route("/game/<int:game_id>")
+@read_only
 def game_details(game_id):
     try:
-        game = db.session.get(Game, game_id)
-        page, per_page, offset = get_page_args(
-            page_parameter="page", per_page_parameter="per_page"
+        per_page = max(1, min(request.args.get("per_page", 10, type=int), 100))
+        cursor = request.args.get("cursor")
+        total = counters.hand_count(game_id, counters.epoch)
+        latest_id = db.session.scalar(
+            select(func.max(Hand.id)).where(Hand.game_id == game_id)
         )
-        total = Hand.query.filter_by(game_id=game_id).count()
-        hands = (
-            Hand.query.filter_by(game_id=game_id).offset(offset).limit(per_page).all()
+        etag = make_etag(
+            "game", counters.load_token, game_id, latest_id, total, cursor, per_page
         )
-        pagination = Pagination(
-            page=page, per_page=per_page, total=total, css_framework="bootstrap4"
+        if is_fresh(etag):
+            return with_etag(app.response_class(status=304), etag)
+        game = db.session.get(Game, game_id)
+        hands, prev_cursor, next_cursor = cursor_paginate(
+            Hand.query.filter_by(game_id=game_id).options(selectinload(Hand.rounds)),
+            Hand.id,
+            cursor,
+            per_page,
         )
-        return render_template(
-            "game_details.html", game=game, hands=hands, pagination=pagination
+        response = make_response(
+            render_template(
+                "game_details.html",
+                game=game,
+                hands=hands,
+                total=total,
+                per_page=per_page,
+                prev_cursor=prev_cursor,
+                next_cursor=next_cursor,
+            )
         )
+        return with_etag(response, etag)
     except Exception as e:
         logger.error(f"Error fetching game details for game_id: {game_id}. Error: {e}")
         return "An error occurred."
 
 
+# Built once so each request only binds parameters against a cached compile.
+# The backref attributes used below only exist once mappers are configured.
+configure_mappers()
+
+# Each level of the hand is fetched with one parameter-only IN query
+ROUNDS_BY_HAND = (
+    select(Round)
+    .where(Round.hand_id == bindparam("hand_id"))
+    .options(
+        selectinload(Round.actions).joinedload(PlayerAction.player),
+        selectinload(Round.board_cards),
+    )
+    .order_by(Round.id)
+)
+# Plain rows: the player table only needs a few columns, not ORM entities
+ACTION_ROWS_BY_PLAYER = (
+    select(
+        Hand.hand_number,
+        PlayerAction.action,
+        PlayerAction.amount,
+        Round.round_name,
+        PlayerAction.position,
+        PlayerAction.is_all_in,
+    )
+    .select_from(PlayerAction)
+    .join(Round, PlayerAction.round_id == Round.id)
+    .join(Hand, Round.hand_id == Hand.id)
+    .where(PlayerAction.player_id == bindparam("player_id"))
+    .order_by(PlayerAction.id)
+)
+
+
 @app.route("/hand/<int:hand_id>")
+@read_only
 def hand_details(hand_id):
     try:
         hand = db.session.get(Hand, hand_id)
-        rounds = Round.query.filter_by(hand_id=hand_id).all()
-        actions = PlayerAction.query.join(Round).filter(Round.hand_id == hand_id).all()
-        board_cards = BoardCard.query.join(Round).filter(Round.hand_id == hand_id).all()
-        return render_template(
-            "hand_details.html", hand=hand, actions=actions, board_cards=board_cards
+        # Ingested hands never change, so their identity is a stable validator
+        # Player ids are reassigned by a reload, so the links need the token
+        etag = make_etag(
+            counters.load_token, hand.id, hand.game_id, hand.hand_number
         )
+        if is_fresh(etag):
+            return with_etag(app.response_class(status=304), etag)
+        rounds = db.session.scalars(ROUNDS_BY_HAND, {"hand_id": hand_id}).all()
+        response = make_response(
+            render_template("hand_details.html", hand=hand, rounds=rounds)
+        )
+        return with_etag(response, etag)
     except Exception as e:
         logger.error(f"Error fetching hand details for hand_id: {hand_id}. Error: {e}")
         return "An error occurred."
 
 
 @app.route("/player/<int:player_id>")
+@read_only
 def player_details(player_id):
     try:
         player = db.session.get(Player, player_id)
-        actions = PlayerAction.query.filter_by(player_id=player_id).all()
-        return render_template("player_details.html", player=player, actions=actions)
+        if player is None:
+            # Errors raised while streaming would bypass this handler
+            raise ValueError("Player not found")
+        # Heavy players have tens of thousands of actions, so fetch them in
+        # batches while the page is streamed instead of materializing them all
+        actions = db.session.execute(
+            ACTION_ROWS_BY_PLAYER,
+            {"player_id": player_id},
+            execution_options={"yield_per": 500},
+        )
+        return app.response_class(
+            stream_template("player_details.html", player=player, actions=actions)
+        )
     except Exception as e:
         logger.error(
             f"Error fetching player details for player_id: {player_id}. Error: {e}"
@@ -137,11 +422,26 @@ def player_details(player_id):
         return "An error occurred."
 
 
-@app.route("/player/<int:player_id>/recalculate_stats")
+# SQLite allows a single writer, so concurrent recalculations queue here
+# instead of contending for the write lock and hitting busy timeouts
+stats_lock = threading.Lock()
+
+# Stats only change when the hand histories are reloaded, so a player
+# recalculated in the last RECALC_TTL seconds of the same load is left alone
+RECALC_TTL = 30
+recalculated_at = {}
+
+
+@app.route("/player/<int:player_id>/recalculate_stats", methods=["POST"])
 def recalculate_stats(player_id):
     try:
         player = db.session.get(Player, player_id)
-        player.recalculate_stats()
+        with stats_lock:
+            epoch, last = recalculated_at.get(player_id, (None, None))
+            now = time.monotonic()
+            if epoch != counters.epoch or now - last > RECALC_TTL:
+                player.recalculate_stats()
+                recalculated_at[player_id] = (counters.epoch, now)
         logger.info(f"Recalculated stats for player {player.name}")
         return jsonify(success=True)
     except Exception as e:
@@ -151,38 +451,77 @@ def recalculate_stats(player_id):
         return jsonify(success=False, error=str(e))
 
 
+# Resets re-parse every file in data, which takes far longer than a request
+# should, so they run one at a time on this worker; jobs maps id -> status
+reset_executor = ThreadPoolExecutor(max_workers=1)
+jobs = {}
+
+
+def run_reset_job(job_id):
+    jobs[job_id] = {"status": "running"}
+    try:
+        with app.app_context():
+            rebuild_database()
+        jobs[job_id] = {"status": "done"}
+    except Exception as e:
+        logger.error(f"Error resetting database. Error: {e}")
+        jobs[job_id] = {"status": "failed", "error": str(e)}
+
+
 @app.route("/reset_db")
 def reset_db():
     try:
         # Close the existing database session
         db.session.remove()
-        # Dispose of the existing database engine
-        db.engine.dispose()
-
-        if os.path.exists("instance/poker_hands.db"):
-            os.remove("instance/poker_hands.db")
-            logger.info("Deleted existing database.")
-        db.create_all()
-        logger.info("Created new database.")
-        from parse_files import parse_files
-
-        parse_files("data")
-        return jsonify(success=True)
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {"status": "queued"}
+        reset_executor.submit(run_reset_job, job_id)
+        return jsonify(
+            success=True,
+            job_id=job_id,
+            status_url=url_for("job_status", job_id=job_id),
+        )
     except Exception as e:
         logger.error(f"Error resetting database. Error: {e}")
         return jsonify(success=False, error=str(e))
 
 
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(success=False, error="Unknown job.")
+    return jsonify(success=True, job_id=job_id, **job)
+
+
+def warm_template_cache():
+    # Compile every template up front so no request pays the first-hit cost
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+warm_template_cache()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Poker Hand History Processor")
     parser.add_argument(
         "-p", "--persist", action="store_true", help="Persist the database"
     )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        action="store_true",
+        help="Run with the Werkzeug debugger and reloader",
+    )
     args = parser.parse_args()
 
-    initialize_db(args.persist)
+    # With --debug the reloader re-runs this script in a child process; the
+    # database was already built by the parent, so don't rebuild it there
+    if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        initialize_db(args.persist)
 
     try:
-        app.run(debug=True)
+        app.run(debug=args.debug, threaded=True)
     except Exception as e:
         logger.error(f"Error running the Flask app. Error: {e}")
@@ -0,0 +1,32 @@
+import functools
+import uuid
+
+from sqlalchemy import func, select
+
+from models import Game, Hand, db
+
+# Bumped after every write to the hand history tables; cached counts are
+# keyed on it, so bumping invalidates them all at once
+epoch = 0
+# Names the current load of the hand history tables in page ETags. Unlike
+# epoch it never repeats: ids restart at 1 on every rebuild and every startup
+# rebuild ends on the same epoch, so neither can tell two loads apart
+load_token = uuid.uuid4().hex
+
+
+def bump():
+    global epoch, load_token
+    epoch += 1
+    load_token = uuid.uuid4().hex
+
+
+@functools.lru_cache(maxsize=64)
+def game_count(epoch):
+    return db.session.scalar(select(func.count(Game.id)))
+
+
+@functools.lru_cache(maxsize=4096)
+def hand_count(game_id, epoch):
+    return db.session.scalar(
+        select(func.count(Hand.id)).where(Hand.game_id == game_id)
+    )
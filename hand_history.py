@@ -0,0 +1,151 @@
+import re
+
+# Indexed by round number, which starts at 1
+ROUND_NAMES = ("", "Pre-Flop", "Flop", "Turn", "River", "Showdown")
+
+# Lines other than player actions are told apart by their first word
+LINE_KINDS = {
+    "Game": "game",
+    "Round": "round",
+    "**": "dealing",
+    "Seat": "seat",
+    "Player": "player",
+}
+
+# Finds and locates the action in one scan; the player name is everything
+# before it
+ACTION_RE = re.compile(r" (re-raises|posts|calls|raises|folds|posted ante)\b")
+
+# Fields of the other line kinds, each read in a single match
+GAME_RE = re.compile(r"Game #(\S+) (starts|ends)")
+SEAT_RE = re.compile(r"Seat (\d+): (.+?) \(([\d,]+) ")
+CARD_RE = re.compile(r"\[([^\]]*)\]")
+LEAVES_RE = re.compile(r"Player (.+?) leaves the table")
+
+# Bracketed amounts, e.g. "[1,500 Tournament chips]", and posted antes
+AMOUNT_RE = re.compile(r"\[([\d,]+)[ \]]")
+ANTE_RE = re.compile(r"posted ante of\s*([\d,]+)")
+
+
+def extract_amount(text):
+    match = AMOUNT_RE.search(text) or ANTE_RE.search(text)
+    if match:
+        return int(match.group(1).replace(",", ""))
+    return 0  # No amount to extract
+
+
+# The read_* and parse_* functions below run in parse_files' worker processes.
+# They turn a hand history file into plain lists and tuples and never touch the
+# database; errors are collected and returned so the main process can log them.
+
+
+def parse_player_action_line(line, action_match, errors):
+    player_name = line[: action_match.start()].strip()
+    action = action_match.group(1)
+    if not player_name:
+        raise ValueError("No valid action found in line")
+    try:
+        amount = extract_amount(line)
+    except Exception as e:
+        errors.append(f"Error extracting amount from text: {line}. Error: {e}")
+        amount = None
+    return player_name, action, amount, None
+
+
+def parse_seat_line(line):
+    seat_match = SEAT_RE.match(line)
+    if not seat_match:
+        raise ValueError("Not a valid seat line")
+    seat, player, chips = seat_match.groups()
+    return player.strip(), "seat", int(chips.replace(",", "")), int(seat)
+
+
+def new_round(round_number):
+    return {
+        "round_number": round_number,
+        "round_name": (
+            ROUND_NAMES[round_number]
+            if round_number < len(ROUND_NAMES)
+            else f"Round {round_number}"
+        ),
+        "actions": [],
+        "board_cards": [],
+    }
+
+
+def read_hand_history(path):
+    """Parse the hand history file at ``path`` into a dict of plain data.
+
+    Each hand holds its rounds in order, and each round its actions as
+    ``(player_name, action, amount, seat_number)`` tuples and its board cards.
+    """
+    hands = []
+    leaves = []
+    errors = []
+    hand = None
+    round_entry = None
+    game_started = False
+    hand_started = False
+    round_number = 1
+
+    with open(path, "r", buffering=1 << 20) as f:
+        # Only the header is read here; the loop streams the rest
+        game_number = next(f).split("#: ")[1].strip()
+        for line in f:
+            kind = LINE_KINDS.get(line.partition(" ")[0])
+            # Matched once here and reused by the "game" branch below
+            game_match = GAME_RE.match(line) if kind == "game" else None
+            is_start = game_match is not None and game_match.group(2) == "starts"
+            if is_start:
+                game_started = True
+                hand_started = True
+
+            if not game_started:
+                continue
+
+            try:
+                if kind is None:
+                    # Player action lines start with the player's name, so they
+                    # come through here without testing any of the prefixes
+                    if hand_started and (action_match := ACTION_RE.search(line)):
+                        round_entry["actions"].append(
+                            parse_player_action_line(line, action_match, errors)
+                        )
+                    elif hand_started and "shows" in line:
+                        player_name = line.split("shows")[0].strip()
+                        # No amount for show action
+                        round_entry["actions"].append((player_name, "shows", 0, None))
+                elif kind == "game":
+                    if is_start:
+                        hand_number = game_match.group(1)
+                        round_entry = new_round(round_number)
+                        hand = {"hand_number": hand_number, "rounds": [round_entry]}
+                        hands.append(hand)
+                    elif game_match:
+                        hand = None
+                        hand_started = False
+                        round_number = 1  # Reset round number for the next hand
+                elif kind == "round":
+                    if hand_started and "is over" in line:
+                        round_number += 1
+                        round_entry = new_round(round_number)
+                        hand["rounds"].append(round_entry)
+                elif kind == "dealing":
+                    if hand_started and line.startswith("** Dealing"):
+                        card_match = CARD_RE.search(line)
+                        round_entry["board_cards"].append(card_match.group(1))
+                elif kind == "seat":
+                    if hand_started:
+                        round_entry["actions"].append(parse_seat_line(line))
+                elif kind == "player":
+                    if leaves_match := LEAVES_RE.match(line):
+                        leaves.append(leaves_match.group(1))
+            except Exception as e:
+                errors.append(f"Error processing line: {line}. Error: {e}")
+
+    return {
+        "game_number": game_number,
+        "hands": hands,
+        "leaves": leaves,
+        "errors": errors,
+    }
@@ -0,0 +1,64 @@
+import atexit
+import logging
+import os
+import queue
+from datetime import datetime
+from logging.handlers import (
+    MemoryHandler,
+    QueueHandler,
+    QueueListener,
+    WatchedFileHandler,
+)
+
+log_dir = "./logs"
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+log_listener = None
+
+
+def init_logging():
+    """Start the background listener that writes queued records to the log
+    file and console. Only the first call does any work.
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+
+    # Create the /logs directory if it doesn't exist
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Configure logging to write to a file and to the console; the file is
+    # only created once the first record is written
+    log_filename = datetime.now().strftime(f"{log_dir}/%d%m%y_%H%M%S.txt")
+    file_handler = WatchedFileHandler(log_filename, delay=True)
+    file_handler.setLevel(logging.DEBUG)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.ERROR)  # Only print ERROR messages to console
+
+    # Create a logging format
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    # Batch file writes and hand records to a background thread so logging
+    # callers never block on disk I/O
+    buffered_file_handler = MemoryHandler(
+        1024, flushLevel=logging.ERROR, target=file_handler
+    )
+    log_listener = QueueListener(
+        log_queue, buffered_file_handler, console_handler, respect_handler_level=True
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+def get_logger(name, level=logging.DEBUG):
+    """Return the logger ``name`` writing to this process's single log file."""
+    init_logging()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
+    return logger
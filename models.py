@@ -1,8 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import distinct
+from sqlalchemy import case, distinct
 from sqlalchemy.sql import func
 
-db = SQLAlchemy()
+# Objects keep their loaded state across commits; nothing here edits rows
+# behind the session's back, so re-SELECTing after every commit is waste
+db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 
 class Game(db.Model):
@@ -15,10 +17,11 @@ class Game(db.Model):
     num_players = db.Column(db.Integer)
 
     def update_num_players(self):
+        # Counted straight off player_action; the player table adds nothing
         self.num_players = (
-            db.session.query(func.count(distinct(Player.id)))
-            .join(PlayerAction, Player.id == PlayerAction.player_id)
-            .join(Hand, Hand.id == PlayerAction.round_id)
+            db.session.query(func.count(distinct(PlayerAction.player_id)))
+            .join(Round, PlayerAction.round_id == Round.id)
+            .join(Hand, Round.hand_id == Hand.id)
             .filter(Hand.game_id == self.id)
             .scalar()
         )
@@ -26,6 +29,8 @@ class Game(db.Model):
 
 
 class Hand(db.Model):
+    __table_args__ = (db.Index("ix_hand_game_id", "game_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     game_id = db.Column(db.Integer, db.ForeignKey("game.id"), nullable=False)
     hand_number = db.Column(db.String(20), nullable=False)
@@ -34,12 +39,18 @@ class Hand(db.Model):
 
 
 class Round(db.Model):
+    __table_args__ = (db.Index("ix_round_hand_id", "hand_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     hand_id = db.Column(db.Integer, db.ForeignKey("hand.id"), nullable=False)
     round_number = db.Column(db.Integer, nullable=False)
     round_name = db.Column(db.String(20), nullable=False)
-    actions = db.relationship("PlayerAction", backref="round", lazy=True)
-    board_cards = db.relationship("BoardCard", backref="round", lazy=True)
+    actions = db.relationship(
+        "PlayerAction", backref="round", lazy=True, order_by="PlayerAction.id"
+    )
+    board_cards = db.relationship(
+        "BoardCard", backref="round", lazy=True, order_by="BoardCard.id"
+    )
     starting_chips = db.Column(
         db.JSON, nullable=True
     )  # Stores starting chip counts for each player
@@ -50,6 +61,8 @@ class Round(db.Model):
 
 
 class Player(db.Model):
+    __table_args__ = (db.Index("ix_player_game_id", "game_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     game_id = db.Column(db.Integer, db.ForeignKey("game.id"), nullable=False)
@@ -68,45 +81,30 @@ class Player(db.Model):
 
     @property
     def hands(self):
-        hands = set()
-        for action in self.actions:
-            if action.round.hand:
-                hands.add(action.round.hand)
-        return list(hands)
+        # One DISTINCT query rather than lazy loading each action's round
+        # and hand in turn
+        return (
+            Hand.query.join(Round, Round.hand_id == Hand.id)
+            .join(PlayerAction, PlayerAction.round_id == Round.id)
+            .filter(PlayerAction.player_id == self.id)
+            .distinct()
+            .all()
+        )
 
     def recalculate_stats(self):
-        self.total_chips_won = sum(
-            action.amount for action in self.actions if action.action == "wins"
-        )
-        self.total_chips_lost = sum(
-            action.amount for action in self.actions if action.action == "loses"
-        )
-        self.total_hands_played = (
-            db.session.query(func.count(PlayerAction.id))
+        # Every counter comes from one pass over the player's actions
+        (
+            self.total_chips_won,
+            self.total_chips_lost,
+            self.total_hands_played,
+            self.vpip_count,
+            self.pfr_count,
+            self.uopfr_count,
+        ) = (
+            db.session.query(*stats_columns())
+            .join(Round, PlayerAction.round_id == Round.id)
             .filter(PlayerAction.player_id == self.id)
-            .scalar()
-        )
-        self.vpip_count = (
-            db.session.query(func.count(PlayerAction.id))
-            .filter(
-                PlayerAction.player_id == self.id,
-                PlayerAction.action.in_(["calls", "raises", "re-raises"]),
-            )
-            .scalar()
-        )
-        self.pfr_count = (
-            db.session.query(func.count(PlayerAction.id))
-            .filter(PlayerAction.player_id == self.id, PlayerAction.action == "raises")
-            .scalar()
-        )
-        self.uopfr_count = (
-            db.session.query(func.count(PlayerAction.id))
-            .filter(
-                PlayerAction.player_id == self.id,
-                PlayerAction.action == "raises",
-                PlayerAction.position == "UTG",
-            )
-            .scalar()
+            .one()
         )
         self.final_chip_count = (
             self.chips_start + self.total_chips_won - self.total_chips_lost
@@ -118,17 +116,97 @@ class Player(db.Model):
         db.session.commit()
 
 
+def stats_columns():
+    """Aggregates behind Player's stat columns, over PlayerAction rows joined
+    to their Round.
+
+    The rules are the ones parse_files applies as it stores each action: VPIP
+    counts calls and raises in any round, PFR raises and re-raises in the
+    first round, and UOPFR plain raises in the first round.
+    """
+    preflop = Round.round_number == 1
+    return (
+        func.coalesce(
+            func.sum(case((PlayerAction.action == "wins", PlayerAction.amount))), 0
+        ),
+        func.coalesce(
+            func.sum(case((PlayerAction.action == "loses", PlayerAction.amount))), 0
+        ),
+        func.count(PlayerAction.id),
+        func.count(
+            case((PlayerAction.action.in_(["calls", "raises", "re-raises"]), 1))
+        ),
+        func.count(
+            case(
+                (preflop & PlayerAction.action.in_(["raises", "re-raises"]), 1)
+            )
+        ),
+        func.count(case((preflop & (PlayerAction.action == "raises"), 1))),
+    )
+
+
+# Stored as the index into this tuple; append new actions, never reorder
+ACTIONS = (
+    "seat",
+    "posts",
+    "posted ante",
+    "calls",
+    "raises",
+    "re-raises",
+    "folds",
+    "shows",
+    "wins",
+    "loses",
+)
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+
+class ActionType(db.TypeDecorator):
+    """An action name, stored as a small integer code from ACTIONS.
+
+    Python code reads and compares plain action strings; the table and its
+    indexes only hold the codes.
+    """
+
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return ACTION_CODES[value]
+        except KeyError:
+            raise ValueError(f"Unknown action: {value}") from None
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else ACTIONS[value]
+
+
 class PlayerAction(db.Model):
+    __table_args__ = (
+        db.Index("ix_playeraction_round_id", "round_id"),
+        # Also serves lookups on player_id alone, as its leftmost column
+        db.Index(
+            "ix_playeraction_player_id_action_position",
+            "player_id",
+            "action",
+            "position",
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     round_id = db.Column(db.Integer, db.ForeignKey("round.id"), nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey("player.id"), nullable=False)
-    action = db.Column(db.String(20), nullable=False)
+    action = db.Column(ActionType, nullable=False)
     amount = db.Column(db.Integer)
     position = db.Column(db.String(20))  # e.g., Small Blind, Big Blind, UTG
     is_all_in = db.Column(db.Boolean, default=False)
 
 
 class BoardCard(db.Model):
+    __table_args__ = (db.Index("ix_boardcard_round_id", "round_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     round_id = db.Column(db.Integer, db.ForeignKey("round.id"), nullable=False)
     card = db.Column(db.String(2), nullable=False)
@@ -138,6 +216,8 @@ class BoardCard(db.Model):
 
 
 class Pot(db.Model):
+    __table_args__ = (db.Index("ix_pot_hand_id", "hand_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     hand_id = db.Column(db.Integer, db.ForeignKey("hand.id"), nullable=False)
     pot_type = db.Column(db.String(20))  # Main pot or side pot
@@ -146,6 +226,11 @@ class Pot(db.Model):
 
 
 class PotWinner(db.Model):
+    __table_args__ = (
+        db.Index("ix_potwinner_pot_id", "pot_id"),
+        db.Index("ix_potwinner_player_id", "player_id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     pot_id = db.Column(db.Integer, db.ForeignKey("pot.id"), nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey("player.id"), nullable=False)
@@ -1,338 +1,381 @@
 import logging
+import multiprocessing
 import os
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, time
 
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from tqdm import tqdm
 
+from hand_history import read_hand_history
+from log_config import get_logger
 from models import BoardCard, Game, Hand, Player, PlayerAction, Round, db
 
-log_dir = "./logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+# The parser logs a debug record per stored row, so those are opt-in:
+# PARSER_LOG_LEVEL=DEBUG turns them on
+logger = get_logger(__name__, os.environ.get("PARSER_LOG_LEVEL", "INFO").upper())
+# Checked by the per-action and per-card debug calls; parse_files re-reads it
+# at the start of every run, so a level changed at runtime takes effect
+debug_enabled = logger.isEnabledFor(logging.DEBUG)
 
-# Configure logging to write to a file and to the console
-log_filename = datetime.now().strftime(f"{log_dir}/%d%m%y_%H%M%S.txt")
-file_handler = logging.FileHandler(log_filename)
-file_handler.setLevel(logging.DEBUG)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.ERROR)
+# Hand history files are read by hand_history.read_hand_history in worker
+# processes; everything here runs in the main process, the only database writer
 
-# Create a logging format
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
 
-# Add the handlers to the logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# The writer inserts with the tables' Core constructs, which skip the ORM's
+# per-row bookkeeping; none of the rows are needed again as objects
 
-ROUND_NAMES = {1: "Pre-Flop", 2: "Flop", 3: "Turn", 4: "River", 5: "Showdown"}
-
-
-def extract_amount(text):
-    try:
-        if "[" in text and "]" in text:
-            return int(text.split("[")[1].split(" ")[0].replace(",", ""))
-        elif "posted ante" in text:
-            return int(
-                text.rsplit("ante of")[1].rsplit("Tournament")[0].replace(",", "")
-            )
-        return 0  # No amount to extract
-    except Exception as e:
-        logger.error(f"Error extracting amount from text: {text}. Error: {e}")
-        return None
 
+def create_hand(game_id, hand_number):
+    hand_table = Hand.__table__
+    hand = db.session.execute(
+        insert(hand_table)
+        .values(game_id=game_id, hand_number=hand_number)
+        .returning(hand_table.c.id, hand_table.c.game_id, hand_table.c.hand_number)
+    ).one()
+    logger.debug("Created new hand entry %s for game %s", hand_number, game_id)
+    return hand
 
-def extract_player_name_and_action(line, action_keywords):
-    for action in action_keywords:
-        if action in line:
-            player_name = line.rsplit(action, 1)[0].strip()
-            return player_name, action
-    return None, None
 
+def create_rounds(hand_id, rounds):
+    """Insert all of a hand's rounds at once and return their ids in order."""
+    round_table = Round.__table__
+    round_ids = db.session.scalars(
+        insert(round_table).returning(round_table.c.id, sort_by_parameter_order=True),
+        [
+            {
+                "hand_id": hand_id,
+                "round_number": round_data["round_number"],
+                "round_name": round_data["round_name"],
+            }
+            for round_data in rounds
+        ],
+    ).all()
+    logger.debug("Created %s round entries for hand %s", len(round_ids), hand_id)
+    return round_ids
+
+
+def create_player(name, game_id, seat_number, chips_start):
+    # One round trip: a row only comes back if the name was new. The name
+    # cache means a conflict needs another writer to have added the player.
+    # No wins or losses are parsed, so the chip columns are what
+    # recalculate_stats would derive from the starting stack
+    player_record = db.session.execute(
+        sqlite_insert(Player)
+        .values(
+            name=name,
+            game_id=game_id,
+            seat_number=seat_number,
+            chips_start=chips_start,
+            final_chip_count=chips_start,
+            big_blinds_remaining=chips_start / 100 if chips_start else 0.0,
+        )
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(Player.id, Player.chips_start)
+    ).first()
+    if player_record is None:
+        player_record = db.session.execute(
+            select(Player.id, Player.chips_start).where(Player.name == name)
+        ).one()
+    logger.debug(
+        "Created new player entry %s at seat %s with %s chips in game %s",
+        name,
+        seat_number,
+        chips_start,
+        game_id,
+    )
+    return player_record
+
+
+def store_action(
+    player_name,
+    action,
+    amount,
+    seat,
+    round_id,
+    round_name,
+    is_preflop,
+    hand,
+    game_number,
+    action_rows,
+    players,
+    stats,
+):
+    player_record = players.get(player_name)
+    if not player_record:
+        if action == "shows":
+            logger.error(
+                f"Player record not found for {player_name} when processing show line"
+            )
+            return
+        # Add player dynamically if not found; a seat line brings its seat
+        # and stack, any other action starts the player from nothing
+        if action == "seat":
+            player_record = create_player(player_name, hand.game_id, seat, amount)
+        else:
+            player_record = create_player(player_name, hand.game_id, -1, 0)
+        players[player_name] = player_record
+
+    action_rows.append(
+        {
+            "round_id": round_id,
+            "player_id": player_record.id,
+            "action": action,
+            "amount": amount,
+        }
+    )
+    # Counts are added up here and written once per file by
+    # update_player_stats. Hands played is kept in step with every action
+    # row, as recalculate_stats counts them
+    player_stats = stats.setdefault(player_record.id, [0, 0, 0, 0])
+    player_stats[0] += 1
+    if debug_enabled:
+        logger.debug(
+            "Added action %s by player %s for %s chips in round %s for hand %s in game %s",
+            action,
+            player_name,
+            amount,
+            round_name,
+            hand.hand_number,
+            game_number,
+        )
 
-def extract_blinds(line):
-    try:
-        parts = line.split(" ")
-        sb = int(parts[parts.index("Small") + 2])
-        bb = int(parts[parts.index("Big") + 2])
-        return sb, bb
-    except Exception as e:
-        logger.error(f"Error extracting blinds from text: {line}. Error: {e}")
-        return None, None
+    # Update player statistics
+    if action in ["re-raises", "calls", "raises"]:
+        player_stats[1] += 1  # Increment VPIP count
+        if is_preflop:
+            player_stats[2] += (
+                1 if action in ["re-raises", "raises"] else 0
+            )  # Increment PFR count
+            player_stats[3] += 1 if action == "raises" else 0  # Increment UOPFR count
+
+
+# Adds a file's counts to each player's totals in one executemany
+PLAYER_STATS_UPDATE = (
+    update(Player.__table__)
+    .where(Player.__table__.c.id == bindparam("player_id"))
+    .values(
+        total_hands_played=Player.__table__.c.total_hands_played + bindparam("hands"),
+        vpip_count=Player.__table__.c.vpip_count + bindparam("vpip"),
+        pfr_count=Player.__table__.c.pfr_count + bindparam("pfr"),
+        uopfr_count=Player.__table__.c.uopfr_count + bindparam("uopfr"),
+    )
+)
+
+
+def update_player_stats(stats):
+    if stats:
+        db.session.execute(
+            PLAYER_STATS_UPDATE,
+            [
+                {
+                    "player_id": player_id,
+                    "hands": hands,
+                    "vpip": vpip,
+                    "pfr": pfr,
+                    "uopfr": uopfr,
+                }
+                for player_id, (hands, vpip, pfr, uopfr) in stats.items()
+            ],
+        )
 
 
-def process_game_start_line(line, game_id):
-    hand_number = line.split("#")[1].split("starts")[0].strip()
-    hand = Hand(game_id=game_id, hand_number=hand_number)
-    db.session.add(hand)
-    db.session.commit()
-    if hand.id is None:
-        raise ValueError("Hand creation failed; id is None")
-    logger.debug(f"Created new hand entry {hand_number} for game {game_id}")
-    return hand
+def insert_buffered_rows(action_rows, board_card_rows):
+    # One executemany per table instead of a unit-of-work INSERT per object
+    if action_rows:
+        db.session.execute(insert(PlayerAction.__table__), action_rows)
+        action_rows.clear()
+    if board_card_rows:
+        db.session.execute(insert(BoardCard.__table__), board_card_rows)
+        board_card_rows.clear()
+
+
+def store_hand(
+    hand_data, game_id, game_number, players, action_rows, board_card_rows, stats
+):
+    hand = create_hand(game_id, hand_data["hand_number"])
+    round_ids = create_rounds(hand.id, hand_data["rounds"])
+    for round_id, round_data in zip(round_ids, hand_data["rounds"]):
+        round_name = round_data["round_name"]
+        is_preflop = round_data["round_number"] == 1
+        for player_name, action, amount, seat in round_data["actions"]:
+            try:
+                store_action(
+                    player_name,
+                    action,
+                    amount,
+                    seat,
+                    round_id,
+                    round_name,
+                    is_preflop,
+                    hand,
+                    game_number,
+                    action_rows,
+                    players,
+                    stats,
+                )
+            except Exception as e:
+                logger.error(
+                    f"Error storing {action} by {player_name} in hand {hand.hand_number}. Error: {e}"
+                )
+        for card in round_data["board_cards"]:
+            board_card_rows.append({"round_id": round_id, "card": card})
+            if debug_enabled:
+                logger.debug(
+                    "Dealt card %s for round %s in hand %s for game %s",
+                    card,
+                    round_name,
+                    hand.hand_number,
+                    game_number,
+                )
+    logger.debug("Stored hand %s for game %s", hand.hand_number, game_number)
 
 
-def create_new_round(hand_id, round_number):
-    round_name = ROUND_NAMES.get(round_number, f"Round {round_number}")
-    new_round = Round(hand_id=hand_id, round_number=round_number, round_name=round_name)
-    db.session.add(new_round)
-    db.session.commit()
-    if new_round.id is None:
-        raise ValueError("Round creation failed; id is None")
-    logger.debug(f"Created new round entry {round_name} for hand {hand_id}")
-    return new_round
+def store_hand_history(file, history, players):
+    for error in history["errors"]:
+        logger.error(error)
 
+    game_number = history["game_number"]
+    logger.debug("Found game number: %s", game_number)
 
-def process_player_action_line(line, round_entry, game_number, hand):
-    try:
-        action_keywords = [
-            "re-raises",
-            "posts",
-            "calls",
-            "raises",
-            "folds",
-            "posted ante",
-        ]
-        player_name, action = extract_player_name_and_action(line, action_keywords)
-        if not player_name or not action:
-            raise ValueError("No valid action found in line")
-
-        amount = extract_amount(line)
-
-        player_record = Player.query.filter_by(name=player_name).first()
-        if not player_record:
-            # Add player dynamically if not found
-            player_record = Player(
-                name=player_name, game_id=hand.game_id, seat_number=-1, chips_start=0
-            )
-            db.session.add(player_record)
-            db.session.commit()
-            if player_record.id is None:
-                raise ValueError(
-                    f"Player creation failed for {player_name}; id is None"
-                )
-            logger.debug(f"Created new player entry {player_name} dynamically")
+    # Extract game date and time from filename
+    filename = os.path.splitext(file)[0]
+    filename_parts = filename.split(" ")
+    date_str = filename_parts[-2].split("History-")[-1]
+    time_str = filename_parts[-1].replace("_", ":")
+    game_date = date.fromisoformat(date_str)
+    game_time = time.fromisoformat(time_str)
 
-        player_action = PlayerAction(
-            round_id=round_entry.id,
-            player_id=player_record.id,
-            action=action,
-            amount=amount,
+    game = Game.query.filter_by(game_number=game_number).first()
+    if not game:
+        game = Game(game_number=game_number, date=game_date, time=game_time)
+        db.session.add(game)
+        db.session.flush()
+        logger.debug(
+            "Created new game entry: %s with date: %s and time: %s",
+            game_number,
+            game_date,
+            game_time,
         )
-        db.session.add(player_action)
+    else:
         logger.debug(
-            f"Added action {action} by player {player_name} for {amount} chips in round {round_entry.round_name} for hand {hand.hand_number} in game {game_number}"
+            "Game %s already exists in the database. Processing hands...", game_number
         )
 
-        # Update player statistics
-        if action in ["re-raises", "calls", "raises"]:
-            player_record.vpip_count += 1  # Increment VPIP count
-            if round_entry.round_name == "Pre-Flop":
-                player_record.pfr_count += (
-                    1 if action in ["re-raises", "raises"] else 0
-                )  # Increment PFR count
-                player_record.uopfr_count += (
-                    1 if action == "raises" else 0
-                )  # Increment UOPFR count
-
-    except Exception as e:
-        logger.error(f"Error processing player action line: {line}. Error: {e}")
-
+    # Action and board card rows and player counts for the whole file,
+    # written together below
+    action_rows = []
+    board_card_rows = []
+    stats = {}
+    for hand_data in history["hands"]:
+        # A savepoint per hand: a bad hand is rolled back on its own, without
+        # expiring the cached players or losing the rest of the transaction
+        known_players = len(players)
+        buffered = len(action_rows), len(board_card_rows)
+        hand_stats = {}
+        try:
+            with db.session.begin_nested():
+                store_hand(
+                    hand_data,
+                    game.id,
+                    game_number,
+                    players,
+                    action_rows,
+                    board_card_rows,
+                    hand_stats,
+                )
+        except Exception as e:
+            logger.error(
+                f"Error storing hand {hand_data['hand_number']} for game {game_number}. Error: {e}"
+            )
+            # Players created in the failed hand were rolled back with it; they
+            # are the newest entries in the cache. Its buffered rows go too
+            for player_name in list(players)[known_players:]:
+                del players[player_name]
+            del action_rows[buffered[0] :]
+            del board_card_rows[buffered[1] :]
+        else:
+            for player_id, hand_counts in hand_stats.items():
+                file_counts = stats.setdefault(player_id, [0, 0, 0, 0])
+                for i, count in enumerate(hand_counts):
+                    file_counts[i] += count
+
+    # One commit per file; the hands above share its transaction
+    insert_buffered_rows(action_rows, board_card_rows)
+    update_player_stats(stats)
+    db.session.commit()
 
-def process_show_action_line(line, round_entry, game_number, hand):
-    try:
-        action = "shows"
-        parts = line.split("shows")
-        player_name = parts[0].strip()
-        amount = 0  # No amount for show action
-        player_record = Player.query.filter_by(name=player_name).first()
+    for player_name in history["leaves"]:
+        player_record = players.get(player_name)
         if player_record:
-            player_action = PlayerAction(
-                round_id=round_entry.id,
-                player_id=player_record.id,
-                action=action,
-                amount=amount,
-            )
-            db.session.add(player_action)
             logger.debug(
-                f"Player {player_name} shows cards in round {round_entry.round_name} for hand {hand.hand_number} in game {game_number}"
+                "Player %s leaves the table with %s chips",
+                player_name,
+                player_record.chips_start,
             )
         else:
             logger.error(
-                f"Player record not found for {player_name} when processing show line: {line}"
-            )
-    except Exception as e:
-        logger.error(f"Error processing show action line: {line}. Error: {e}")
-
-
-def process_seat_line(line, hand, game_number, round_entry):
-    try:
-        parts = line.split(": ")
-        seat_info = parts[0].split(" ")
-        seat = int(seat_info[1])
-        player_info = parts[1].split(" (")
-        player = player_info[0].strip()
-        chips = int(player_info[1].split(" ")[0].replace(",", ""))
-
-        player_record = Player.query.filter_by(name=player).first()
-        if not player_record:
-            player_record = Player(
-                name=player, game_id=hand.game_id, seat_number=seat, chips_start=chips
+                f"Player record not found for {player_name} when processing leave line"
             )
-            db.session.add(player_record)
-            db.session.commit()
-            if player_record.id is None:
-                raise ValueError(f"Player creation failed for {player}; id is None")
-            logger.debug(
-                f"Created new player entry {player} at seat {seat} with {chips} chips in hand {hand.hand_number} for game {game_number}"
-            )
-        player_action = PlayerAction(
-            round_id=round_entry.id,
-            player_id=player_record.id,
-            action="seat",
-            amount=chips,
-        )
-        db.session.add(player_action)
-        logger.debug(
-            f"Added seat action for player {player} with {chips} chips in round {round_entry.round_name} for hand {hand.hand_number} in game {game_number}"
-        )
-    except Exception as e:
-        logger.error(f"Error processing seat line: {line}. Error: {e}")
-
-
-def process_dealing_line(line, round_entry, game_number, hand):
-    card = line.split("[")[1].split("]")[0]
-    board_card = BoardCard(round_id=round_entry.id, card=card)
-    db.session.add(board_card)
-    logger.debug(
-        f"Dealt card {card} for round {round_entry.round_name} in hand {hand.hand_number} for game {game_number}"
-    )
-
-
-def process_player_leaves_line(line):
-    parts = line.split(" ")
-    player_name = " ".join(parts[1 : parts.index("leaves")])
-    player_record = Player.query.filter_by(name=player_name).first()
-    if player_record:
-        logger.debug(
-            f"Player {player_name} leaves the table with {player_record.chips_start} chips"
-        )
-    else:
-        logger.error(
-            f"Player record not found for {player_name} when processing leave line: {line}"
-        )
-
+    return game
 
-def parse_lines(lines, game_number, game_id):
-    hand = None
-    round_entry = None
-    game_started = False
-    hand_started = False
-    round_number = 1
 
-    for line in lines:
-        if line.startswith("Game #") and "starts" in line:
-            game_started = True
-            hand_started = True
-
-        if not game_started:
-            continue
-
-        try:
-            if line.startswith("Game #") and "starts" in line:
-                if hand:
-                    db.session.commit()
-                    logger.debug(
-                        f"Committed hand {hand.hand_number} for game {game_number}"
-                    )
-                hand = process_game_start_line(line, game_id)
-                round_entry = create_new_round(hand.id, round_number)
-            elif "blinds are" in line:
-                small_blind, big_blind = extract_blinds(line)
-                if hand:
-                    hand.small_blind = small_blind
-                    hand.big_blind_value = big_blind
-                    db.session.commit()
-                    logger.debug(
-                        f"Set blinds for hand {hand.hand_number}: small_blind={small_blind}, big_blind={big_blind}"
-                    )
-            elif line.startswith("Game #") and "ends" in line:
-                db.session.commit()
-                logger.debug(
-                    f"Committed hand {hand.hand_number} for game {game_number}"
-                )
-                hand = None
-                hand_started = False
-                round_number = 1  # Reset round number for the next hand
-            elif hand_started and line.startswith("Round") and "is over" in line:
-                round_number += 1
-                round_entry = create_new_round(hand.id, round_number)
-                logger.debug(
-                    f"Round {round_number} is over, created new round entry for hand {hand.hand_number} in game {game_number}"
-                )
-            elif hand_started and "** Dealing" in line:
-                process_dealing_line(line, round_entry, game_number, hand)
-            elif hand_started and line.startswith("Seat"):
-                process_seat_line(line, hand, game_number, round_entry)
-            elif hand_started and any(
-                action in line
-                for action in [
-                    "re-raises",
-                    "posts",
-                    "calls",
-                    "raises",
-                    "folds",
-                    "posted ante",
-                ]
-            ):
-                process_player_action_line(line, round_entry, game_number, hand)
-            elif hand_started and "shows" in line:
-                process_show_action_line(line, round_entry, game_number, hand)
-            elif line.startswith("Player") and "leaves the table" in line:
-                process_player_leaves_line(line)
-        except Exception as e:
-            logger.error(f"Error processing line: {line}. Error: {e}")
-            db.session.rollback()  # Rollback the session to handle subsequent lines correctly
-    if hand:
-        db.session.commit()
-        logger.debug(f"Committed hand {hand.hand_number} for game {game_number}")
+def worker_context():
+    # Workers forked from a forkserver don't inherit this process's threads
+    # (the server's, the log listener) or any lock they held. Platforms
+    # without it, such as Windows, keep their default start method
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context()
 
 
 def parse_files(data_folder):
+    """Store every hand history file in ``data_folder`` and return the games
+    they touched, whose player counts are left to the caller.
+
+    The worker processes re-import the caller's ``__main__`` module, as
+    multiprocessing does under the forkserver and spawn start methods. A
+    script that calls this must keep its own work under an
+    ``if __name__ == "__main__":`` guard, or every worker runs it again.
+    """
+    global debug_enabled
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    # A game's hands can be split across files; its players are counted once
+    games = {}
     try:
-        files = [f for f in os.listdir(data_folder) if f.endswith(".txt")]
-        for file in tqdm(files, desc="Processing Files"):
-            logger.debug(f"Processing file: {file}")
-            with open(os.path.join(data_folder, file), "r") as f:
-                lines = f.readlines()
-                game_number = lines[0].split("#: ")[1].strip()
-                logger.debug(f"Found game number: {game_number}")
-
-                # Extract game date and time from filename
-                filename = os.path.splitext(file)[0]
-                filename_parts = filename.split(" ")
-                date_str = filename_parts[-2].split("History-")[-1]
-                time_str = filename_parts[-1].replace("_", ":")
-                game_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                game_time = datetime.strptime(time_str, "%H:%M:%S").time()
-
-                game = Game.query.filter_by(game_number=game_number).first()
-                if not game:
-                    game = Game(game_number=game_number, date=game_date, time=game_time)
-                    db.session.add(game)
-                    db.session.commit()
-                    logger.debug(
-                        f"Created new game entry: {game_number} with date: {game_date} and time: {game_time}"
-                    )
-                else:
-                    logger.debug(
-                        f"Game {game_number} already exists in the database. Processing hands..."
-                    )
-
-                parse_lines(lines[1:], game_number, game.id)
-                game.update_num_players()
+        with os.scandir(data_folder) as it:
+            entries = [
+                entry
+                for entry in it
+                if entry.name.endswith(".txt") and entry.is_file()
+            ]
+        # Largest files first, so the long parses start while the pool is
+        # empty instead of running alone at the end
+        entries.sort(key=lambda entry: entry.stat().st_size, reverse=True)
+        files = [entry.name for entry in entries]
+        paths = [entry.path for entry in entries]
+        # Player names are unique, so every line resolves its player here
+        # instead of with a SELECT; new players are added as they're created.
+        # Rows rather than Player objects, which commits would expire
+        players = {
+            player_record.name: player_record
+            for player_record in db.session.execute(
+                select(Player.name, Player.id, Player.chips_start)
+            )
+        }
+        # Files are parsed in parallel by worker processes; their results
+        # come back in file order and are written here, by the only writer
+        with ProcessPoolExecutor(mp_context=worker_context()) as executor:
+            # Small batches save a round trip per file without holding back
+            # the first results
+            histories = executor.map(read_hand_history, paths, chunksize=4)
+            for file, history in tqdm(
+                zip(files, histories), total=len(files), desc="Processing Files"
+            ):
+                logger.debug("Processing file: %s", file)
+                game = store_hand_history(file, history, players)
+                games[game.id] = game
     except Exception as e:
         logger.error(f"Error processing files in folder: {data_folder}. Error: {e}")
+    return list(games.values())